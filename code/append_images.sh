@@ -0,0 +1,24 @@
+#!/bin/bash
+# Add the animation frames of new images to $4/frames, without touching the old frames. Frames are kept as resized
+# pngs, and are only joined into gifs by stitch_images.sh, so the cost here only depends on the number of new frames.
+# $1 is the assets directory, $2 and $3 the normal and diff image types, and $5... the time tags of the new frames.
+AST_DIR=$1
+NORM=$2
+DIFF=$3
+FRAME_DIR=$4/frames
+shift 4
+
+mkdir -p $FRAME_DIR
+
+for TAG in "$@"; do
+FILE_NORM=($AST_DIR/*"$NORM"_"$TAG".jpg)
+FILE_DIFF=($AST_DIR/*"$DIFF"_"$TAG".jpg)
+NAME_NORM=$(basename "$FILE_NORM" .jpg)
+NAME_DIFF=$(basename "$FILE_DIFF" .jpg)
+NAME_BOTH=${NAME_NORM/"$NORM"/"both"}
+
+convert "$FILE_NORM" -resize 50% $FRAME_DIR/"$NAME_NORM".png
+convert "$FILE_DIFF" -resize 50% $FRAME_DIR/"$NAME_DIFF".png
+# Make the joint frame last, as it marks this frame as done when restarting.
+convert "$FILE_NORM" "$FILE_DIFF" +append -resize 50% $FRAME_DIR/"$NAME_BOTH".png
+done
@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 import PIL.Image as Image
 import sunpy.map as smap
 import subprocess as sbp
+import time
 
 
 def load_swpc_events():
@@ -57,21 +58,17 @@ def make_output_directory_structure():
     return
 
 
-def make_ssw_assets():
+def make_ssw_assets(n_workers=1):
     """
     Function to loop over the SWPC CMEs, find all relevant HI1A and HI1B 1-day background images, and produce
     plain, differenced and relative difference images.
+    :param n_workers: Int, number of threads used for the tiled processing of each differenced image. Default 1.
     :return:
     """
 
-    # Get project directories
-    proj_dirs = apt.project_info()
     # Get the swpc cme database
     swpc_cmes = load_swpc_events()
 
-    # TODO: Should I add this into hi_processing? what about a hip.save_img(diff=True)???
-    plain_normalise = mpl.colors.Normalize(vmin=0.0, vmax=0.5)
-    diff_normalise = mpl.colors.Normalize(vmin=-0.05, vmax=0.05)
     img_type_list = ['norm', 'diff']
 
     # Loop over the swpc_cmes and estimate HI1A\B start and stop times
@@ -90,38 +87,236 @@ def make_ssw_assets():
                 hi_files = hip.find_hi_files(cme['t_hi1b_start'], cme['t_hi1b_stop'], craft=craft, camera='hi1',
                                              background_type=1)
 
-            # Loop to make plain and diff images
-            for img_type in img_type_list:
-                # Loop over the hi_files, make each image type
-                files_c = hi_files[1:]
-                files_p = hi_files[0:-1]
-                for fc, fp in zip(files_c, files_p):
-
-                    if img_type == 'norm':
-                        # Get Sunpy map of the image, convert to grayscale image with plain_normalise
-                        hi_map = hip.get_image_plain(fc, star_suppress=False)
-                        out_img = mpl.cm.gray(plain_normalise(hi_map.data), bytes=True)
-                        # Get the image, also, flip upside down as there is no "origin=lower" option within PIL
-                        out_img = Image.fromarray(np.flipud(out_img))
-                    elif img_type == 'diff':
-                        # TODO: What should scaling be for differenced images? What structuing element for median filter?
-                        hi_map = hip.get_image_diff(fc, fp, align=True, smoothing=True)
-                        out_img = mpl.cm.gray(diff_normalise(hi_map.data), bytes=True)
-                        # Get the image, also, flip upside down as there is no "origin=lower" option with PIL
-                        out_img = Image.fromarray(np.flipud(out_img))
-
-                    out_name = "_".join([event_label, craft, img_type, hi_map.date.strftime('%Y%m%d_%H%M%S')]) + '.jpg'
-                    out_path = os.path.join(proj_dirs['out_data'], event_label, craft, 'assets', out_name)
-                    out_img.save(out_path, optimize=True)
+            # Make plain and diff images
+            files_c = hi_files[1:]
+            files_p = hi_files[0:-1]
+            time_tags = make_asset_images(files_c, files_p, event_label, craft, img_type_list, n_workers=n_workers)
 
             # Now create the manifest for this event/craft/type
             make_manifest(event_label, craft, img_type_list, n=3)
-            # Now makes gifs of each image type and join into a joint gif using a shell script for imagemagick
-            # BASH needs forward slashes...
-            ast_dir = os.path.join(proj_dirs['out_data'], event_label, craft, 'assets').replace("\\", "/")
-            ani_dir = os.path.join(proj_dirs['out_data'], event_label, craft, 'animations').replace("\\", "/")
-            shell_dir = os.path.join(proj_dirs['code'], 'combine_images.sh').replace("\\", "/")
-            sbp.call([shell_dir, ast_dir, "norm", "diff", ani_dir], shell=True)
+            # Now make the animation frames, and join them into gifs of each image type and a joint gif. Uses the same
+            # layout as tail_ssw_assets, so an event can be extended with tail_ssw_assets afterwards.
+            append_animation_frames(event_label, craft, time_tags)
+            publish_animations(event_label, craft)
+
+
+def make_asset_images(files_c, files_p, event_label, craft, img_type_list, n_workers=1):
+    """
+    Function to produce the plain and differenced images of a set of HI files, and save them in the assets directory
+    of this event/craft. All image types of a frame are made, then saved, before moving on to the next frame. If any
+    image type of a frame fails, none are saved and the error is raised. Images are named
+    after the time string of the HI file, so asset and HI file names can be matched.
+    :param files_c: List of full paths to the HI files to make images of.
+    :param files_p: List of full paths to the HI files preceding each of files_c, used for the differenced images.
+    :param event_label: String of the event label, as taken from asset_production.make_ssw_assets
+    :param craft: String of the craft label ['sta', 'stb'].
+    :param img_type_list: List of the different image types ['norm', 'diff'].
+    :param n_workers: Int, number of threads used for the tiled processing of each differenced image. Default 1.
+    :return time_tags: List of time strings (yyyymmdd_HHMMSS) of the images produced.
+    """
+    # Get project directories
+    proj_dirs = apt.project_info()
+
+    # TODO: Should I add this into hi_processing? what about a hip.save_img(diff=True)???
+    plain_normalise = mpl.colors.Normalize(vmin=0.0, vmax=0.5)
+    diff_normalise = mpl.colors.Normalize(vmin=-0.05, vmax=0.05)
+
+    time_tags = []
+    # Loop over the hi_files, make each image type
+    for fc, fp in zip(files_c, files_p):
+        # HI files follow naming convention of yyyymmdd_hhmmss_datatag.fts. So first 15 elements give a time string.
+        time_tag = os.path.basename(fc)[:15]
+
+        # Make every image type before saving any, so a failure doesn't leave part of a frame in the assets.
+        out_imgs = []
+        for img_type in img_type_list:
+
+            if img_type == 'norm':
+                # Get Sunpy map of the image, convert to grayscale image with plain_normalise
+                hi_map = hip.get_image_plain(fc, star_suppress=False)
+                out_img = mpl.cm.gray(plain_normalise(hi_map.data), bytes=True)
+                # Get the image, also, flip upside down as there is no "origin=lower" option within PIL
+                out_img = Image.fromarray(np.flipud(out_img))
+            elif img_type == 'diff':
+                # TODO: What should scaling be for differenced images? What structuing element for median filter?
+                hi_map = hip.get_image_diff(fc, fp, align=True, smoothing=True, n_workers=n_workers)
+                out_img = mpl.cm.gray(diff_normalise(hi_map.data), bytes=True)
+                # Get the image, also, flip upside down as there is no "origin=lower" option with PIL
+                out_img = Image.fromarray(np.flipud(out_img))
+
+            out_imgs.append(out_img)
+
+        for img_type, out_img in zip(img_type_list, out_imgs):
+            out_name = "_".join([event_label, craft, img_type, time_tag]) + '.jpg'
+            out_path = os.path.join(proj_dirs['out_data'], event_label, craft, 'assets', out_name)
+            out_img.save(out_path, optimize=True)
+
+        time_tags.append(time_tag)
+
+    return time_tags
+
+
+def tail_ssw_assets(event_idx, craft, poll_interval=600, n_polls=None, n_workers=1, publish=False, max_retries=3):
+    """
+    Function to follow near-real-time HI1 data for an open-ended event. Polls the HI day directories from the start
+    time of the event up to the present, and only processes frames that have arrived since the last processed frame.
+    The first new frame is differenced against the last processed frame. New assets are appended to the existing
+    manifest, and new animation frames are added to the animations/frames directory by append_images.sh, so the cost
+    of each update is proportional to the number of new frames. Joining the frames into gifs (publish_animations)
+    rereads every frame of the event, so costs time proportional to the event length. This is only done on each
+    update if publish=True.
+    If a new frame fails to process (e.g. a partly transferred file), it and any later frames are retried on the next
+    poll. A file that still fails after max_retries polls is skipped, and the next frame is differenced against the
+    last good frame.
+    Can be restarted, as the last processed frame is found from the images and animation frames already made. Only
+    frames with every image type and an animation frame count as processed.
+    :param event_idx: Int index of the event in the SWPC CME database, as used for the event label.
+    :param craft: String of the craft label ['sta', 'stb'].
+    :param poll_interval: Float number of seconds to wait between polls of the HI data.
+    :param n_polls: Int number of polls to make before returning. Default None, which polls until interrupted.
+    :param n_workers: Int, number of threads used for the tiled processing of each differenced image. Default 1.
+    :param publish: Bool, True or False on whether to remake the gifs after every update. Default False.
+    :param max_retries: Int, number of polls a file can fail to process on before it is skipped. Default 3.
+    :return:
+    """
+    if craft not in {'sta', 'stb'}:
+        print("Error: craft should be set to either 'sta', or 'stb'. Defaulting to 'sta'")
+        craft = 'sta'
+
+    if not isinstance(publish, bool):
+        print("Error: publish should be True or False. Defaulting to False")
+        publish = False
+
+    if not isinstance(max_retries, int) or (max_retries < 1):
+        print("Error: max_retries should be an int of 1 or greater. Defaulting to 3")
+        max_retries = 3
+
+    # Get project directories
+    proj_dirs = apt.project_info()
+    # Get the swpc cme database
+    swpc_cmes = load_swpc_events()
+    cme = swpc_cmes.loc[event_idx]
+    event_label = "ssw_{0:03d}_swpc_{1:03d}".format(event_idx, cme['event_id'])
+    img_type_list = ['norm', 'diff']
+
+    if craft == 'sta':
+        t_start = cme['t_hi1a_start']
+    elif craft == 'stb':
+        t_start = cme['t_hi1b_start']
+
+    ast_dir = os.path.join(proj_dirs['out_data'], event_label, craft, 'assets')
+    ani_dir = os.path.join(proj_dirs['out_data'], event_label, craft, 'animations')
+    # Find the last fully processed frame. Names end with the time string yyyymmdd_HHMMSS of the HI file. A crash
+    # could leave the latest frames without a diff image or animation frame, so take the earliest of the latest time
+    # of each output.
+    done_patterns = [os.path.join(ast_dir, '*' + img + '*.jpg') for img in img_type_list]
+    done_patterns.append(os.path.join(ani_dir, 'frames', '*both*.png'))
+    latest_tags = []
+    for pattern in done_patterns:
+        done_tags = [os.path.splitext(os.path.basename(f))[0][-15:] for f in glob.glob(pattern)]
+        if len(done_tags) > 0:
+            latest_tags.append(max(done_tags))
+
+    if len(latest_tags) == len(done_patterns):
+        last_tag = min(latest_tags)
+    else:
+        last_tag = None
+
+    # Number of polls each file has failed on, and files given up on.
+    n_fails = {}
+    skip_files = set()
+
+    i_poll = 0
+    while (n_polls is None) or (i_poll < n_polls):
+
+        # Only search the day directories from the day before the last processed frame, so the cost of each poll
+        # doesn't grow with the event length. HI data times are UTC.
+        if last_tag is None:
+            t_poll = t_start
+        else:
+            t_poll = max(t_start, pd.to_datetime(last_tag[:8], format='%Y%m%d') - pd.Timedelta(days=1))
+
+        # Make sure files are time sorted.
+        hi_files = hip.find_hi_files(t_poll, pd.datetime.utcnow(), craft=craft, camera='hi1', background_type=1)
+        hi_files.sort()
+        hi_tags = [os.path.basename(f)[:15] for f in hi_files]
+
+        # Find first unprocessed frame. The first frame of the event is only used as a preceding frame.
+        if last_tag is None:
+            i_new = 1
+        else:
+            i_new = max(len([t for t in hi_tags if t <= last_tag]), 1)
+
+        files_c = [f for f in hi_files[i_new:] if f not in skip_files]
+
+        if len(files_c) > 0:
+            print("{0} {1}: Processing {2} new frames".format(event_label, craft, len(files_c)))
+            # Process one frame at a time, so a bad file only stops the update at that frame. The preceding frame is
+            # the last good frame.
+            fp = hi_files[i_new - 1]
+            new_tags = []
+            for fc in files_c:
+                try:
+                    new_tags.extend(make_asset_images([fc], [fp], event_label, craft, img_type_list,
+                                                      n_workers=n_workers))
+                except Exception as err:
+                    n_fails[fc] = n_fails.get(fc, 0) + 1
+                    if n_fails[fc] < max_retries:
+                        print("Error: Failed to process {0}, will retry on next poll. {1}".format(fc, err))
+                        break
+                    else:
+                        print("Error: Failed to process {0} on {1} polls, skipping it. {2}".format(fc, n_fails[fc],
+                                                                                                   err))
+                        skip_files.add(fc)
+                        continue
+
+                fp = fc
+
+            if len(new_tags) > 0:
+                last_tag = new_tags[-1]
+                # Extend the manifest and animation frames with the new frames.
+                append_manifest(event_label, craft, img_type_list, n=3)
+                append_animation_frames(event_label, craft, new_tags)
+
+                if publish:
+                    publish_animations(event_label, craft)
+
+        i_poll += 1
+        if (n_polls is None) or (i_poll < n_polls):
+            time.sleep(poll_interval)
+
+
+def append_animation_frames(event_label, craft, time_tags):
+    """
+    Function to add the animation frames of a set of assets to the animations/frames directory of this event/craft,
+    using a shell script for imagemagick. Only the frames given are made, so the cost depends on the number of new
+    frames, not the event length.
+    :param event_label: String of the event label, as taken from asset_production.make_ssw_assets
+    :param craft: String of the craft label ['sta', 'stb'].
+    :param time_tags: List of time strings (yyyymmdd_HHMMSS) of the assets to make frames of.
+    :return:
+    """
+    proj_dirs = apt.project_info()
+    # BASH needs forward slashes...
+    ast_dir = os.path.join(proj_dirs['out_data'], event_label, craft, 'assets').replace("\\", "/")
+    ani_dir = os.path.join(proj_dirs['out_data'], event_label, craft, 'animations').replace("\\", "/")
+    shell_dir = os.path.join(proj_dirs['code'], 'append_images.sh').replace("\\", "/")
+    sbp.call([shell_dir, ast_dir, "norm", "diff", ani_dir] + time_tags, shell=True)
+
+
+def publish_animations(event_label, craft):
+    """
+    Function to join the animation frames made by append_animation_frames into the norm, diff and combined gifs, using a shell
+    script for imagemagick. Every frame of the event is reread, so this costs time proportional to the event length.
+    :param event_label: String of the event label, as taken from asset_production.make_ssw_assets
+    :param craft: String of the craft label ['sta', 'stb'].
+    :return:
+    """
+    proj_dirs = apt.project_info()
+    # BASH needs forward slashes...
+    ani_dir = os.path.join(proj_dirs['out_data'], event_label, craft, 'animations').replace("\\", "/")
+    shell_dir = os.path.join(proj_dirs['code'], 'stitch_images.sh').replace("\\", "/")
+    sbp.call([shell_dir, ani_dir, "norm", "diff"], shell=True)
 
 
 def make_manifest(event, craft, img_type, n=3):
@@ -171,27 +366,86 @@ def make_manifest(event, craft, img_type, n=3):
             files = [os.path.basename(f) for f in files]
             # Make sure files are time sorted.
             files.sort()
+            sub_id = write_manifest_rows(manifest, files, asset_name_part1, img, sub_id, n)
+
 
-            i=0
-            while (i+n) <= len(files):
-                # File names have format ssw_aaa_swpc_bbb_craft_camera_type_yyyymmdd_HHMMSS.jpg
-                # Pull out the times of the first and nth file to be linked to make asset name
-                i_n = i + n
-                fi = os.path.splitext(files[i])[0].split('_')
-                ti = fi[6] + 'T' + fi[7]
-                fn = os.path.splitext(files[i_n-1])[0].split('_')
-                tn = fn[6] + 'T' + fn[7]
-                # Form full asset name
-                asset_name_part2 = ti + '_' + tn
-                asset_name_full = "_".join([asset_name_part1,asset_name_part2])
-                manifest_elements =[str(sub_id), asset_name_full, img]
-                # Add on the subset of files
-                manifest_elements.extend(files[i: i_n])
-                # Write out as comma sep list.
-                manifest.write(",".join(manifest_elements) + "\n")
-                i = i_n
-                sub_id += 1
-                # TODO: Add in check to make sure all files are processed? Or add in staement to say which files werent?
+def append_manifest(event, craft, img_type, n=3):
+    """
+    This function extends an existing manifest produced by make_manifest with any assets not yet listed in it. Files
+    are linked in sets of n in time order, exactly as make_manifest, and subject ids continue on from the largest in
+    the manifest. Any files left over that do not make a full set are left for a later update. If no manifest exists,
+    one is made with make_manifest.
+    :param event: String of the event label, as taken from asset_production.make_assets
+    :param craft: String of the craft label ['sta', 'stb'], as taken from asset_production.make_assets
+    :param img_type: List of the different image types ['norm', 'diff'], as taken from asset_production.make_assets
+    :param n:  Number of images to link together in the manifest for each asset.
+    :return: Appends to the "manifest.csv" file in the event/craft/type directory of these images.
+    """
+    proj_dirs = apt.project_info()
+
+    if not isinstance(n, int):
+        print("Error: n should be integer. Converting")
+        n = int(n)
+
+    data_dir = os.path.join(proj_dirs['out_data'], event, craft, 'assets')
+    manifest_path = os.path.join(data_dir, 'manifest.csv')
+    if not os.path.exists(manifest_path):
+        make_manifest(event, craft, img_type, n=n)
+        return
+
+    # Get the files already in the manifest, and the last subject id.
+    listed_files = set()
+    sub_id = 0
+    with open(manifest_path, 'r') as manifest:
+        # Skip the header
+        lines = manifest.read().splitlines()[1:]
+        for line in lines:
+            manifest_elements = line.split(',')
+            sub_id = max(sub_id, int(manifest_elements[0]) + 1)
+            listed_files.update(manifest_elements[3:])
+
+    with open(manifest_path, 'a') as manifest:
+        for img in img_type:
+            asset_name_part1 = "_".join([event, craft, img])
+            files = glob.glob(os.path.join(data_dir, '*' + img + '*.jpg'))
+            files = [os.path.basename(f) for f in files if os.path.basename(f) not in listed_files]
+            files.sort()
+            sub_id = write_manifest_rows(manifest, files, asset_name_part1, img, sub_id, n)
+
+
+def write_manifest_rows(manifest, files, asset_name_part1, img, sub_id, n):
+    """
+    This function writes rows to an open manifest file, linking the files in consecutive sets of n.
+    :param manifest: Open file object of the manifest.
+    :param files: List of time sorted asset file names (without path) to link together.
+    :param asset_name_part1: String of the first part of the asset name, event_craft_type.
+    :param img: String of the image type of these files.
+    :param sub_id: Int subject id of the first row to write.
+    :param n:  Number of images to link together in the manifest for each asset.
+    :return sub_id: Int subject id of the next row.
+    """
+    i=0
+    while (i+n) <= len(files):
+        # File names have format ssw_aaa_swpc_bbb_craft_camera_type_yyyymmdd_HHMMSS.jpg
+        # Pull out the times of the first and nth file to be linked to make asset name
+        i_n = i + n
+        fi = os.path.splitext(files[i])[0].split('_')
+        ti = fi[6] + 'T' + fi[7]
+        fn = os.path.splitext(files[i_n-1])[0].split('_')
+        tn = fn[6] + 'T' + fn[7]
+        # Form full asset name
+        asset_name_part2 = ti + '_' + tn
+        asset_name_full = "_".join([asset_name_part1,asset_name_part2])
+        manifest_elements =[str(sub_id), asset_name_full, img]
+        # Add on the subset of files
+        manifest_elements.extend(files[i: i_n])
+        # Write out as comma sep list.
+        manifest.write(",".join(manifest_elements) + "\n")
+        i = i_n
+        sub_id += 1
+        # TODO: Add in check to make sure all files are processed? Or add in staement to say which files werent?
+
+    return sub_id
 
 
 def test_scaling():
@@ -290,6 +544,28 @@ def test_diff_image():
     himap = hip.get_image_diff(hi1a_files[2], hi1a_files[1], star_suppress=False, align=True, smoothing=True)
     himap.peek()
 
+def test_tiling():
+    """
+    Function to test that the tiled processing in hi_processing.get_image_diff gives identical output to the untiled
+    processing.
+    :return:
+    """
+    t_start = pd.datetime(year=2008, month=1, day=1)
+    t_stop = t_start + pd.Timedelta(days=1)
+
+    hi1a_files = hip.find_hi_files(t_start, t_stop, craft='sta', camera='hi1', background_type=1)
+
+    for star_suppress in [False, True]:
+        hi_map = hip.get_image_diff(hi1a_files[1], hi1a_files[0], star_suppress=star_suppress, align=True,
+                                    smoothing=True)
+        for n_workers in [2, 3, 7, 2000]:
+            hi_map_tiled = hip.get_image_diff(hi1a_files[1], hi1a_files[0], star_suppress=star_suppress, align=True,
+                                              smoothing=True, n_workers=n_workers)
+            # NaNs in the same place count as equal.
+            np.testing.assert_array_equal(hi_map.data, hi_map_tiled.data)
+            print("star_suppress={0}, n_workers={1}: tiled matches untiled".format(star_suppress, n_workers))
+
+
 def test_image_orientation():
     """
     Function to test the error handling is behaving as expected in hi_processing.get_image_diff
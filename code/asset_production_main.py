@@ -5,11 +5,13 @@ def main():
 
     ap.make_output_directory_structure()
     ap.make_ssw_assets()
+    # ap.tail_ssw_assets(0, 'sta')
     # ap.test_scaling()
     # ap.test_interpolation()
     # ap.test_alignment()
     # ap.test_diff_image()
     # ap.test_image_orientation()
+    # ap.test_tiling()
     return
 
 if __name__ == '__main__':
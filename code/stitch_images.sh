@@ -0,0 +1,11 @@
+#!/bin/bash
+# Join the animation frames in $1/frames, made by append_images.sh, into gifs of the normal ($2), diff ($3) and joint
+# frames in $1. Reads every frame, so the cost depends on the event length.
+FRAME_DIR=$1/frames
+
+for TYPE in $2 $3 both; do
+IMG_ARR=($FRAME_DIR/*$TYPE*.png)
+FILENAME=$(basename "$IMG_ARR")
+FILENAME=${FILENAME:0:25}
+convert -delay 0 -loop 0 $FRAME_DIR/*$TYPE*.png $1/"$FILENAME".gif
+done